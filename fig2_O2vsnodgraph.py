@@ -4,17 +4,36 @@ plot_nod_vs_oxygen.py
 
 Creates a scatter plot of the number of nod genes detected versus oxygen concentration,
 fits a linear regression line, computes the R² score, and displays an anoxic cutoff.
+Pass ``--save [PATH]`` to write the figure (default fig2.png) with the Agg backend
+instead of showing it; this is also done automatically on Linux when no display
+($DISPLAY / $WAYLAND_DISPLAY) is available.
 """
 
 # Import necessary libraries
+import argparse
 import os                                   
+import sys
+import matplotlib
 import matplotlib.pyplot as plt             
 import numpy as np                         
 import pandas as pd                        
-from sklearn.metrics import r2_score        
 
 
-def main():
+def headless():
+    """True when no display is available to show a window (Linux without X/Wayland)."""
+    return sys.platform.startswith("linux") and not (
+        os.environ.get("DISPLAY") or os.environ.get("WAYLAND_DISPLAY")
+    )
+
+
+def main(save_path=None):
+    # Batch/headless runs: use the non-interactive Agg renderer and write the
+    # figure to disk instead of opening a window
+    if save_path is None and headless():
+        save_path = "fig2.png"
+    if save_path is not None:
+        matplotlib.use("Agg")
+
     # -------------------------------------------------------------------------
     # 1. Load your data using a relative path (place df_all_o2readings.csv in same folder as script
     # -------------------------------------------------------------------------
@@ -24,15 +43,20 @@ def main():
     # -------------------------------------------------------------------------
     # 2. Extract the variables for plotting
     # -------------------------------------------------------------------------
-    x = df_ALL["# of nod genes"]   # number of nod genes detected in each sample
-    y = df_ALL["Oxygen"]           # corresponding oxygen concentration measurements
+    x = np.asarray(df_ALL["# of nod genes"], dtype=np.float64)  # number of nod genes detected in each sample
+    y = np.asarray(df_ALL["Oxygen"], dtype=np.float64)          # corresponding oxygen concentration measurements
 
     # -------------------------------------------------------------------------
     # 3. Fit a simple linear regression
     # -------------------------------------------------------------------------
-    slope, intercept = np.polyfit(x, y, 1)  # returns [slope, intercept]
+    # Closed-form least squares from the centred sums of squares/products
+    xm, ym = x.mean(), y.mean()
+    dx, dy = x - xm, y - ym
+    sxy, sxx = dx @ dy, dx @ dx
+    slope = sxy / sxx                      # cov(x, y) / var(x)
+    intercept = ym - slope * xm
     y_pred = slope * x + intercept         # predicted y values using the fitted line
-    r_squared = r2_score(y, y_pred)        # coefficient of determination (R²)
+    r_squared = (sxy * sxy) / (sxx * (dy @ dy))  # coefficient of determination (R²)
 
     # -------------------------------------------------------------------------
     # 4. Configure global plotting parameters
@@ -42,7 +66,7 @@ def main():
     # -------------------------------------------------------------------------
     # 5. Create the figure and scatter plot
     # -------------------------------------------------------------------------
-    plt.figure(figsize=(10, 7))
+    fig = plt.figure(figsize=(10, 7))
     plt.scatter(
         x,
         y,
@@ -81,12 +105,26 @@ def main():
     plt.title("Scatter Plot of # of nod genes vs Oxygen")
 
     # -------------------------------------------------------------------------
-    # 9. Add legend and display
+    # 9. Add legend and display (or save to save_path in batch mode)
     # -------------------------------------------------------------------------
     plt.legend()
     plt.tight_layout()  # adjust spacing to prevent clipping of labels
-    plt.show()
+    if save_path is not None:
+        fig.savefig(save_path, dpi=150)
+        plt.close(fig)  # release the figure's buffers
+    else:
+        plt.show()
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--save",
+        nargs="?",
+        const="fig2.png",
+        default=None,
+        metavar="PATH",
+        help="save the figure to PATH (default fig2.png) instead of showing it",
+    )
+    args, _ = parser.parse_known_args()  # tolerate extra argv, e.g. under Jupyter's %run
+    main(args.save)
@@ -11,8 +11,9 @@ Required input files
 
 Output files generated
 ======================
-* **all_sum_CPM.csv** – tidy summary matrix (rows = samples, columns =
-  marker genes) containing summed CPM counts.  Overwritten if it already exists.
+* **all_sum_CPM.parquet** (or **all_sum_CPM.csv** with ``OUT_FMT = "csv"``) –
+  tidy summary matrix (rows = samples, columns = marker genes) containing
+  summed CPM counts.  Overwritten if it already exists.
 
 --------------------------------------------------------------------------
 This script does **one thing**:
@@ -28,14 +29,21 @@ Adjust the dictionaries right below (``MARKER_DOMTBL``, ``SYNONYM_MAP``) and the
 
     python marker_aggregate.py
 
-Dependencies: pandas ≥ 1.0
+Dependencies: pandas ≥ 1.5, pyarrow, numba
 """
 
 from __future__ import annotations
-import re
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, Iterator, List, Tuple
+
+from numba import njit, prange
 
 ###############################################################################
 # 1. User-editable configuration
@@ -83,92 +91,205 @@ SYNONYM_MAP: Dict[str, str] = {
 # Path to the huge CPM matrix (tab-separated, one row per OM-RGC gene, one column per sample)
 COUNTS_TSV = "counts_cpm.tsv"  # <-- change me if needed
 
+# Output format: "parquet" (fast columnar binary) or "csv"
+OUT_FMT = "parquet"
+
 ###############################################################################
 # 2. Helper functions
 ###############################################################################
 
+@njit(cache=True, nogil=True)
+def _scan_domtbl(buf: np.ndarray) -> np.ndarray:
+    """Return ``(start, end)`` byte offsets of the target ID on every data line.
+
+    *buf* is the raw file as ``uint8``.  Lines starting with ``#`` are skipped,
+    and each ID is cut at the first ``/<digit>`` so trailing domain coords
+    (e.g. “…/1-250”) never make it into the result.
+    """
+    n = buf.shape[0]
+    n_lines = 1
+    for i in range(n):
+        if buf[i] == 10:  # '\n'
+            n_lines += 1
+    out = np.empty((n_lines, 2), dtype=np.int64)  # upper bound on data lines
+    k = 0
+    i = 0
+    while i < n:
+        if buf[i] != 35:  # '#'
+            # skip leading blanks, then take the first whitespace token
+            while i < n and (buf[i] == 32 or buf[i] == 9):
+                i += 1
+            start = i
+            end = -1
+            while i < n and buf[i] != 32 and buf[i] != 9 and buf[i] != 10 and buf[i] != 13:
+                if end < 0 and buf[i] == 47 and i + 1 < n and 48 <= buf[i + 1] <= 57:
+                    end = i  # '/' followed by a digit
+                i += 1
+            if end < 0:
+                end = i
+            if i > start:
+                out[k, 0] = start
+                out[k, 1] = end
+                k += 1
+        # advance to the start of the next line
+        while i < n and buf[i] != 10:
+            i += 1
+        i += 1
+    return out[:k]
+
+
+# fastmath without the "nnan"/"ninf" flags, so the NaN test below survives
+@njit(parallel=True, cache=True, fastmath={"reassoc", "contract", "nsz", "arcp"})
+def _accumulate(vals: np.ndarray, marker_idx: np.ndarray, out: np.ndarray) -> None:
+    """Add each gene row of *vals* onto row ``marker_idx[g]`` of *out* in place.
+
+    Threads split the sample columns, so no two threads ever write the same
+    cell of *out*.  Missing (NaN) CPMs are skipped, i.e. count as zero.
+    """
+    n_genes, n_samples = vals.shape
+    for s in prange(n_samples):
+        for g in range(n_genes):
+            v = vals[g, s]
+            if v == v:  # not NaN
+                out[marker_idx[g], s] += v
+
+
 def parse_domtbl(path: str | Path, marker: str) -> pd.DataFrame:
     """Return a 1-column DataFrame of OM-RGC IDs that hit *marker*.
 
     Assumes the **target/sequence** ID is in the **first** whitespace-separated
     column of each non-comment line (standard `--domtblout` layout).
     """
-    ids: List[str] = []
-    with open(path, "r") as handle:
-        for ln in handle:
-            if ln.startswith("#"):  # skip comments
-                continue
-            seq_id = ln.split(maxsplit=1)[0]
-            # “clean” the ID if it contains trailing domain coords (e.g. “…/1-250”)
-            seq_id = re.sub(r"/\d+.*", "", seq_id)
-            ids.append(seq_id)
+    buf = np.fromfile(path, dtype=np.uint8)
+    off = _scan_domtbl(buf)
+    # slice one bytes object with plain ints; per-row NumPy slicing dominated
+    data = buf.tobytes()
+    ids = [data[a:b].decode() for a, b in off.tolist()]
 
     df = pd.DataFrame({"OMRGC_ID": ids})
     df["marker"] = marker  # annotate
     return df.drop_duplicates()
 
+
+def _parse_one(item: Tuple[str, str]) -> pd.DataFrame:
+    """`parse_domtbl` for one ``(marker, file)`` pair of `MARKER_DOMTBL`."""
+    marker, file = item
+    return parse_domtbl(Path(file), marker)
+
+
+def iter_filtered(
+    reader: pacsv.CSVStreamingReader, id_arr: pa.Array, sample_cols: List[str]
+) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """Yield ``(gene_codes, vals)`` for the rows of each batch whose ID is in *id_arr*.
+
+    *gene_codes* are positions in *id_arr*; *vals* is the matching
+    ``(n_rows, n_samples)`` float32 CPM block.  Batches are consumed one at a
+    time, so only the current one is ever held in memory.
+    """
+    for batch in reader:
+        codes = pc.index_in(batch.column("OMRGC_ID"), value_set=id_arr)
+        if codes.null_count == len(codes):
+            continue
+        # Filter only the sample columns (the ID strings are never copied), then
+        # let to_pandas() build one float32 block that to_numpy() returns as-is;
+        # callers only read it, so the view may stay read-only.
+        mask = pc.is_valid(codes)
+        samples = pa.Table.from_batches([batch]).select(sample_cols)
+        vals = samples.filter(mask).to_pandas().to_numpy(dtype=np.float32)
+        yield pc.drop_null(codes).to_numpy(), vals
+
 ###############################################################################
 # 3. Build the gene-to-marker lookup table
 ###############################################################################
 
-all_hits: List[pd.DataFrame] = []
 for marker, file in MARKER_DOMTBL.items():
-    fp = Path(file)
-    if not fp.exists():
+    if not Path(file).exists():
         raise FileNotFoundError(f"Expected domtblout for marker '{marker}' at {file}")
-    df_marker = parse_domtbl(fp, marker)
-    all_hits.append(df_marker)
 
-dedup = pd.concat(all_hits, ignore_index=True).drop_duplicates("OMRGC_ID")
+# Threads let the byte scan (the only nogil step) of one file overlap with the
+# decoding of another; decoding and the DataFrame build still hold the GIL.
+# `ex.map` keeps MARKER_DOMTBL order, which the dedup below relies on.
+with ThreadPoolExecutor() as ex:
+    all_hits: List[pd.DataFrame] = list(ex.map(_parse_one, MARKER_DOMTBL.items()))
+
+# Keep the first marker seen for each gene; a hash-based duplicated() on the
+# flat ID array avoids hashing whole DataFrame rows.
+ids = np.concatenate([h["OMRGC_ID"].to_numpy() for h in all_hits])
+mks = np.concatenate([h["marker"].to_numpy() for h in all_hits])
+keep = ~pd.Index(ids).duplicated()
+dedup = pd.DataFrame({"OMRGC_ID": ids[keep], "marker": mks[keep]})
 
 # Apply synonym mapping (case-insensitive)
-idx = dedup["marker"].str.lower().map(lambda x: SYNONYM_MAP.get(x, x))
-dedup["marker"] = idx
+lowered = dedup["marker"].str.lower()
+dedup["marker"] = lowered.map(SYNONYM_MAP).fillna(lowered)
 
 ###############################################################################
-# 4. Stream-read the massive CPM matrix, filtering to relevant IDs
+# 4. Stream-read the massive CPM matrix, aggregating per marker as we go
 ###############################################################################
 
-chunks: List[pd.DataFrame] = []
-CHUNKSIZE = 200_000  # adjust based on RAM
-cols_to_keep: List[str] | None = None  # will discover header lazily
-
-for chunk in pd.read_csv(COUNTS_TSV, sep="\t", chunksize=CHUNKSIZE):
-    # Lazily determine which columns we actually want (all samples + OMRGC_ID)
-    if cols_to_keep is None:
-        samples = [c for c in chunk.columns if c != "OMRGC_ID"]
-        cols_to_keep = ["OMRGC_ID"] + samples
-    chunk = chunk[cols_to_keep]
-    chunk = chunk[chunk["OMRGC_ID"].isin(dedup["OMRGC_ID"])].copy()
-    if not chunk.empty:
-        chunks.append(chunk)
-
-if not chunks:
-    raise RuntimeError("No overlapping OMRGC_IDs between CPM table and HMMER hits!")
+# PyArrow parses the TSV multi-threaded and lets us filter each record batch
+# column-wise before anything is converted to NumPy.  Each surviving batch is
+# scatter-added into a dense (marker × sample) array straight away by the
+# multi-threaded `_accumulate` kernel, so the working set never grows beyond
+# N_markers × N_samples.
+BLOCK_SIZE = 1 << 26  # bytes per record batch (64 MiB); adjust based on RAM
 
-counts_df = pd.concat(chunks, ignore_index=True)
+# `pc.index_in` turns each gene ID into its int32 row position in `dedup`
+# (null when the gene is not a marker hit), and that position indexes directly
+# into `gene_to_marker`, so no string hashing happens after the filter.
+id_arr = pa.array(dedup["OMRGC_ID"].to_numpy(), type=pa.string())
+marker_names, gene_to_marker = np.unique(dedup["marker"].to_numpy(), return_inverse=True)
+gene_to_marker = gene_to_marker.astype(np.intp)
 
-###############################################################################
-# 5. Aggregate CPMs per sample × marker
-###############################################################################
+read_opts = pacsv.ReadOptions(block_size=BLOCK_SIZE)
+parse_opts = pacsv.ParseOptions(delimiter="\t")
 
-# Map each gene to its marker label
-counts_df["marker"] = counts_df["OMRGC_ID"].map(dedup.set_index("OMRGC_ID")["marker"])
+# Take the column names from Arrow's own header parse (quoting, BOM, encoding
+# all handled the same way as the real read; costs one block), so every column
+# gets a fixed type instead of being inferred from the first block only.
+# float32 is ample precision for per-gene CPM values.
+probe = pacsv.open_csv(COUNTS_TSV, read_options=read_opts, parse_options=parse_opts)
+header: List[str] = probe.schema.names
+probe.close()
+sample_cols: List[str] = [c for c in header if c != "OMRGC_ID"]
+cols_to_keep = ["OMRGC_ID"] + sample_cols
+col_types = {"OMRGC_ID": pa.string(), **{c: pa.float32() for c in sample_cols}}
 
-# Melt → long, aggregate, pivot → wide
-long_df = counts_df.melt(id_vars=["OMRGC_ID", "marker"], var_name="sample", value_name="CPM")
-long_df = long_df[long_df["CPM"] > 0]  # ignore zero rows to speed up groupby
+reader = pacsv.open_csv(
+    COUNTS_TSV,
+    read_options=read_opts,
+    parse_options=parse_opts,
+    convert_options=pacsv.ConvertOptions(column_types=col_types, include_columns=cols_to_keep),
+)
+
+result = np.zeros((len(marker_names), len(sample_cols)), dtype=np.float64)
+n_matched = 0
+for gene_codes, vals in iter_filtered(reader, id_arr, sample_cols):
+    marker_idx = gene_to_marker[gene_codes]
+    _accumulate(vals, marker_idx, result)
+    n_matched += len(marker_idx)
+
+if not n_matched:
+    raise RuntimeError("No overlapping OMRGC_IDs between CPM table and HMMER hits!")
+
+###############################################################################
+# 5. Reshape to samples × markers
+###############################################################################
 
-final = (
-    long_df
-    .groupby(["sample", "marker"], sort=False)["CPM"].sum()
-    .unstack(fill_value=0)
-    .sort_index(axis=1)
+final = pd.DataFrame(
+    result.T,
+    index=pd.Index(sample_cols, name="sample"),
+    columns=pd.Index(marker_names, name="marker"),
 )
 
 ###############################################################################
 # 6. Write result
 ###############################################################################
 
-final.to_csv("all_sum_CPM.csv")
-print("✔ Aggregated CPM matrix written to all_sum_CPM.csv")
+if OUT_FMT == "parquet":
+    out_path = "all_sum_CPM.parquet"
+    pq.write_table(pa.Table.from_pandas(final), out_path, compression="zstd")
+else:
+    out_path = "all_sum_CPM.csv"
+    final.to_csv(out_path, float_format="%.6g", lineterminator="\n")
+print(f"✔ Aggregated CPM matrix written to {out_path}")